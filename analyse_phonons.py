@@ -37,6 +37,22 @@ def write_weird(name, path, p, img, pc, imgc):
             f.write(f'{GRID[pc[:, idx] < 0]}\n')
 
 
+def load_supercell(supercells, compound, path):
+    """
+    Gets the supercell used for a compound from `supercells.npz`, falling back to the
+    `supercell.npy` file that older versions of `run_phonon.py` saved in each compound's directory.
+
+    :param supercells: Mapping of compound names to supercells, as stored in `supercells.npz`
+    :param compound: The name of the compound
+    :param path: The path to the directory containing the results for the compound
+    :return: The flattened 3x3 supercell matrix
+    """
+    try:
+        return supercells[compound]
+    except KeyError:
+        return np.load(os.path.join(path, 'supercell.npy'))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--cell', action='store_true',
@@ -62,6 +78,12 @@ if __name__ == '__main__':
 
     directories = glob.glob(os.path.join(results_dir, '*', ''))
 
+    supercells_path = os.path.join(results_dir, 'supercells.npz')
+    if os.path.exists(supercells_path):
+        with np.load(supercells_path) as f:
+            supercells = dict(zip(f['names'].tolist(), f['matrices']))
+    else:
+        supercells = {}
 
     failed_supercells = []
     successful_supercells = []
@@ -90,7 +112,7 @@ if __name__ == '__main__':
                         fc_name=f'{compound}-force_constants.hdf5'
                     )
             except RuntimeError:
-                supercell = np.load(os.path.join(dir, 'supercell.npy'))
+                supercell = load_supercell(supercells, compound, dir)
                 print('euphonic failed - supercell=', supercell, ' det=', np.linalg.det(supercell.reshape((3, 3))))
                 failed_supercells.append(supercell)
                 print()
@@ -105,7 +127,7 @@ if __name__ == '__main__':
             np.save(out, phonons)
             np.save(out_correction, phonons_correction)
 
-        successful_supercells.append(np.load(os.path.join(dir, 'supercell.npy')))     
+        successful_supercells.append(load_supercell(supercells, compound, dir))     
 
         imaginary = np.sum(phonons < 0, axis=0) > 0
         imaginary_correction = np.sum(phonons_correction < 0, axis=0) > 0
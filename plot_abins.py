@@ -14,6 +14,8 @@ Assumptions:
    file names and the instrument used in the neutron experiment. More details can be found in
    :py:func:`parse_csv_data`.
 """
+from __future__ import annotations
+
 import argparse
 import csv
 import glob
@@ -28,6 +30,14 @@ HOME_DIR = os.path.dirname(os.path.abspath(__file__))
 RESULTS_DIR = os.path.join(HOME_DIR, 'results')
 INS_DIR = os.path.join(HOME_DIR, 'data', 'ins')
 
+# Marker files written by `analyse_phonons.py` for calculations without problematic imaginary modes
+SUCCESS_MARKERS = {'ACCEPTABLE', 'WEIRD-OK', 'OK', 'GREAT'}
+
+# The columns of `data.csv` (see :py:func:`parse_csv_data`)
+INSTRUMENT_COLUMN = 1
+DEUTERATION_COLUMN = 2
+FILE_COLUMN = 3
+
 
 def parse_csv_data() -> dict[str, dict[str, str]]:
     """
@@ -78,34 +88,22 @@ def parse_csv_data() -> dict[str, dict[str, str]]:
         next(reader)
 
         for line in reader:
-            file_field = line[3]
+            file_field = line[FILE_COLUMN]
             if not file_field:
                 continue
 
-            if ',' in file_field:
-                for file in file_field.split(','):
-                    key = file.strip().replace('.cif', '')
-                    deuteration = line[2].lower()
-                    try:
-                        result[key]
-                    except KeyError:
-                        result[key] = {}
-
-                    result[key][deuteration] = line[1]
-            else:
-                key = file_field.strip().replace('.cif', '')
-                deuteration = line[2].lower()
-                try:
-                    result[key]
-                except KeyError:
-                    result[key] = {}
+            instrument = line[INSTRUMENT_COLUMN]
+            deuteration = line[DEUTERATION_COLUMN].lower()
 
-                result[key][deuteration] = line[1]
+            # A row can list multiple structure files separated by commas
+            for file in file_field.split(','):
+                key = file.strip().replace('.cif', '')
+                result.setdefault(key, {})[deuteration] = instrument
 
     return result
 
 
-def parse_data_file(path: str) -> list[list[float]]:
+def parse_data_file(path: str) -> np.ndarray:
     """
     Parses a data (ASCII) file from the ISIS INS database
     (http://wwwisis2.isis.rl.ac.uk/INSdatabase/Theindex.asp). The file is assumed to be an output
@@ -114,7 +112,6 @@ def parse_data_file(path: str) -> list[list[float]]:
     :param path: Path to the file to parse
     :return: The table of data from the file.
     """
-    out = []
     delimiter = None
     with open(path, 'r') as f:
         for line in f:
@@ -130,16 +127,10 @@ def parse_data_file(path: str) -> list[list[float]]:
         else:
             raise Exception('parsing error')
 
-        out.append([float(val.strip()) for val in line.strip().split(delimiter)])
-
-        for line in f:
-            try:
-                out.append([float(val.strip()) for val in line.split(delimiter)])
-            except ValueError:
-                print(line, delimiter, line.split(delimiter))
-                raise
+        lines = [line]
+        lines.extend(f)
 
-    return split_parsed_data(out)
+    return np.loadtxt(split_parsed_data(lines, delimiter), delimiter=delimiter, ndmin=2)
 
 
 def has_data_started(line: list[str]) -> bool:
@@ -169,14 +160,15 @@ def normalise_data(abins_x: np.ndarray,
     datasets to be equal. The restriction is used because experimental data can contain a massive
     elastic peak near 0 $cm^{-1}$, which can mess with the normalisation.
 
-    :param abins_x: The computed frequency data
+    :param abins_x: The computed frequency data, sorted in ascending order
     :param abins_y: The computed S(q, w)
-    :param experimental: The experimental data in a 2D array, where the columns are the x and y data
+    :param experimental: The experimental data in a 2D array, where the columns are the x and y
+                         data, sorted in ascending order of x
 
     :return: The normalised data, and the intensity of the highest peak above 50 $cm^{-1}$
     """
-    abins_start = np.where(abins_x > 50)[0][0]
-    exp_start = np.where(experimental[:, 0] > 50)[0][0]
+    abins_start = np.searchsorted(abins_x, 50., side='right')
+    exp_start = np.searchsorted(experimental[:, 0], 50., side='right')
 
     abins_max = np.max(abins_y[abins_start:])
     exp_max = np.max(experimental[exp_start:, 1])
@@ -186,29 +178,65 @@ def normalise_data(abins_x: np.ndarray,
     return abins_x, abins_y, experimental, max([abins_max, exp_max])
 
 
-def split_parsed_data(data: list[list[float]]) -> list[list[float]]:
+def split_parsed_data(data: list[str], delimiter: str | None = None) -> list[str]:
     """
     Some Mantid outputs contain multiple tables of data in one file, corresponding to the partial
     and total S(q, w). This function discards all but the last one, which is assumed to be the total
     S(q, w). The tables are assumed to be separated by a single value (as opposed to two or three
     columns of the data itself.
 
-    :param data: The contents of the data file in a list format.
+    :param data: The lines of the data file, starting from the first line of data.
+    :param delimiter: The delimiter separating the columns of the data.
 
-    :return: The last table, marked `2`, in the file.
+    :return: The lines of the last table, marked `2`, in the file.
     """
-    out = []
-
-    for i, line in enumerate(data):
-        if len(line) == 1 and int(line[0]) == 2:
-            break
-    else:
+    separator = next((i for i, line in enumerate(data) if is_table_separator(line, delimiter)),
+                     None)
+    if separator is None:
         return data
 
-    for line in data[i+1:]:
-        out.append(line)
+    return data[separator + 1:]
+
 
-    return out
+def is_table_separator(line: str, delimiter: str | None = None) -> bool:
+    """
+    Checks whether a line of a data file is the single value `2` marking the start of the last
+    table.
+
+    :param line: A line of the data file
+    :param delimiter: The delimiter separating the columns of the data
+
+    :return: Whether the line is the separator
+    """
+    values = line.split(delimiter)
+    return len(values) == 1 and int(float(values[0])) == 2
+
+
+def envelope(x: np.ndarray, y: np.ndarray, n_bins: int = 4000) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Decimates data for plotting by replacing it with its min/max envelope. The x range is split
+    into `n_bins` equal bins, and each non-empty bin is represented by its minimum and maximum
+    value placed at the centre of the bin, so that peaks are preserved while the number of points
+    sent to matplotlib is reduced to at most 2 * `n_bins`.
+
+    :param x: The x data, sorted in ascending order
+    :param y: The y data
+    :param n_bins: The number of bins to split the x range into
+
+    :return: The decimated x and y data
+    """
+    if len(x) <= 2 * n_bins:
+        return x, y
+
+    edges = np.linspace(x[0], x[-1], n_bins + 1)
+    starts = np.unique(np.searchsorted(x, edges[:-1]))
+    ends = np.append(starts[1:], len(x))
+
+    mins = np.minimum.reduceat(y, starts)
+    maxs = np.maximum.reduceat(y, starts)
+    centres = (x[starts] + x[ends - 1]) / 2
+
+    return np.repeat(centres, 2), np.column_stack([mins, maxs]).ravel()
 
 
 if __name__ == '__main__':
@@ -243,20 +271,18 @@ if __name__ == '__main__':
 
     directories = glob.glob(os.path.join(results_dir, '*', ''))
 
+    fig, ax = plt.subplots(dpi=2000)
+
     for directory in directories:
         compound = os.path.split(os.path.split(directory)[0])[-1]
+        contents = set(os.listdir(directory))
 
-        if not args.replot and os.path.exists(os.path.join(directory, f'{compound}.png')):
+        if not args.replot and f'{compound}.png' in contents:
             print(f'Skipping {compound} because already complete')
             continue
         
         print()
-        if not (
-            os.path.exists(os.path.join(directory, 'ACCEPTABLE')) or
-            os.path.exists(os.path.join(directory, 'WEIRD-OK')) or
-            os.path.exists(os.path.join(directory, 'OK')) or
-            os.path.exists(os.path.join(directory, 'GREAT'))
-        ):
+        if not contents & SUCCESS_MARKERS:
             print(f'skipping {compound} because of imaginary modes')
             continue
 
@@ -268,15 +294,13 @@ if __name__ == '__main__':
             print(f'skipping {compound} due to not having TOSCA measurements')
             continue
 
-        try:
+        if 'force_constants.hdf5' not in contents:
             os.symlink(os.path.join(directory, f'{compound}-force_constants.hdf5'),
                        os.path.join(directory, 'force_constants.hdf5'))
-        except FileExistsError:
-            pass
 
         print(compound)
 
-        if os.path.exists(os.path.join(directory, f'abins.npy')):
+        if 'abins.npy' in contents:
             result = np.load(os.path.join(directory, 'abins.npy'))
             energy = result[0, :]
             s = result[1, :]
@@ -297,20 +321,19 @@ if __name__ == '__main__':
             np.save(os.path.join(directory, 'abins.npy'),
                     np.stack([energy, s]))
 
+            # Remove the HDF5 cache that AbINS writes for each run
+            for file in glob.glob(os.path.join(HOME_DIR, '*.hdf5')):
+                os.remove(file)
+
         ins_data = parse_data_file(os.path.join(INS_DIR, f'{compound}.dat'))
-        try:
-            ins_data = np.array(ins_data)
-        except ValueError:
-            for val in ins_data:
-                print(val)
-            raise
 
         energy, s, ins_data, y_max = normalise_data(energy, s, ins_data)
 
-        fig, ax = plt.subplots(dpi=2000)
+        ax.clear()
 
-        ax.plot(ins_data[:, 0], ins_data[:, 1], label='Experimental', alpha=0.7, c='#1E5DF8', linewidth=2.5)
-        ax.plot(energy, s, label='AbINS', alpha=0.7, c='#E94D36', linewidth=2.5)
+        ax.plot(*envelope(ins_data[:, 0], ins_data[:, 1]), label='Experimental', alpha=0.7, c='#1E5DF8',
+                linewidth=2.5)
+        ax.plot(*envelope(energy, s), label='AbINS', alpha=0.7, c='#E94D36', linewidth=2.5)
 
         ax.set_xlabel('Energy transfer $(cm^{-1})$', fontsize=20)
         ax.set_ylabel('S(q, w)', fontsize=20)
@@ -324,17 +347,14 @@ if __name__ == '__main__':
         ax.tick_params(length=5, width=2, labelsize=15)
         ax.axes.get_yaxis().set_ticks([])
 
-        plt.legend(fontsize=15)
+        ax.legend(fontsize=15)
 
         fig.tight_layout()
         fig.savefig(os.path.join(directory, f'{compound}.png'))
-        plt.close(fig)
 
         try:
             result.delete()
         except (NameError, AttributeError):
             pass
 
-    created_hdf_files = glob.glob(os.path.join(HOME_DIR, '*.hdf5'))
-    for file in created_hdf_files: 
-        os.remove(file)
+    plt.close(fig)
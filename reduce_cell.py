@@ -2,9 +2,12 @@
 Script for reducing the unit cell of a system into the primitive unit cell.
 """
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import filecmp
 import glob
-from io import TextIOWrapper
+from io import BytesIO, TextIOWrapper
 import os
+import re
 from shutil import rmtree, copyfile
 import subprocess
 
@@ -16,23 +19,96 @@ VASP_DIR = os.path.join(DATA_DIR, 'vasp')
 OUT_DIR = os.path.join(DATA_DIR, 'primitive')
 EXTRA_DIR = os.path.join(OUT_DIR, 'extra_data')
 
-
-class CustomFile(TextIOWrapper):
-    def readline(self, size=-1):
-        line = super().readline(size)
-        split = line.split()
-        lens = [len(val) < 3 for val in split]
-        
-        if all(lens) and 'D' in split:
-            line = line.replace('D', 'H')
-        return line
+SPACE_GROUP_NUMBER = re.compile(r'space_group_number\S*\s+(\d+)')
 
 
 def read_vasp_d(filename: str):
     with open(filename, 'rb') as f:
-        f = CustomFile(f)
-        atoms = read(f, format='vasp')
-    return atoms
+        lines = f.readlines()
+
+    # The element symbols are on the sixth line of a POSCAR file
+    elements = [b'H' if e == b'D' else e for e in lines[5].split()]
+    lines[5] = b' '.join(elements) + b'\n'
+
+    return read(TextIOWrapper(BytesIO(b''.join(lines))), format='vasp')
+
+
+def get_space_group_number(work_dir: str) -> int:
+    """
+    Runs `phonopy --symmetry` on the POSCAR file in a directory and reads the space group number
+    from its output.
+
+    :param work_dir: The directory containing the POSCAR file
+    :return: The space group number
+    """
+    result = subprocess.run(['phonopy', '--symmetry'], cwd=work_dir, stdout=subprocess.PIPE, text=True)
+    match = SPACE_GROUP_NUMBER.search(result.stdout)
+    if match is None:
+        raise Exception()
+
+    return int(match.group(1))
+
+
+def reduce_pair(cif2cell_file: str, vesta_file: str) -> bool:
+    """
+    Reduces the cif2cell and VESTA versions of one system to their primitive cells. The VESTA file
+    is abandoned if it is identical to the cif2cell file, or if phonopy finds the same space group
+    for both.
+
+    :param cif2cell_file: The path to the POSCAR file produced by cif2cell
+    :param vesta_file: The path to the POSCAR file produced by VESTA
+
+    :return: Whether the VESTA file was abandoned because the space groups were identical
+    """
+    cif2cell_name = os.path.split(cif2cell_file)[-1]
+    if os.path.exists(os.path.join(OUT_DIR, cif2cell_name)):
+        print(f'{cif2cell_name}: skipping . . .')
+        return False
+
+    if filecmp.cmp(cif2cell_file, vesta_file, shallow=False):
+        identical = True
+    else:
+        try:
+            cif2cell = read(cif2cell_file, format='vasp')
+            vesta = read(vesta_file, format='vasp')
+        except KeyError:
+            cif2cell = read_vasp_d(cif2cell_file)
+            vesta = read_vasp_d(vesta_file)
+
+        identical = cif2cell == vesta
+
+    if identical:
+        print(f'{cif2cell_name}: files identical; skipping VESTA')
+        files = [cif2cell_file]
+    else:
+        files = [cif2cell_file, vesta_file]
+    space_group_number = []
+    for i, file in enumerate(files):
+        name = os.path.split(file)[-1]
+        print(name)
+
+        out_file = os.path.join(OUT_DIR, name)
+        out_dir = os.path.join(EXTRA_DIR, name.replace('.vasp', ''))
+
+        os.makedirs(out_dir)
+        copyfile(file, os.path.join(out_dir, 'POSCAR'))
+
+        space_group_number.append(get_space_group_number(out_dir))
+
+        # Abandon VESTA file if the space group is conserved
+        if i == 1:
+            if space_group_number[0] == space_group_number[1]:
+                print(f'{cif2cell_name}: space groups identical ({space_group_number[0]}); skipping VESTA.')
+
+                rmtree(out_dir)
+                return True
+            else:
+                print(f'{cif2cell_name}: space groups different (cif2cell={space_group_number[0]}, '
+                      f'vesta={space_group_number[1]}); keeping both files.')
+
+        os.replace(os.path.join(out_dir, 'PPOSCAR'), out_file)
+
+    return False
 
 
 if __name__ == '__main__':
@@ -43,6 +119,8 @@ if __name__ == '__main__':
                                                  'the conversion resulted in the same space group; if it did, only one '
                                                  'of the files is kept, but if it didn\'t, both are.')
     parser.add_argument('-r', '--restart', action='store_true', help='Recomputes completed calculations')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='The number of systems to process in parallel. Defaults to the number of CPUs.')
     args = parser.parse_args()
 
     if args.restart:
@@ -61,60 +139,7 @@ if __name__ == '__main__':
     if not os.path.exists(EXTRA_DIR):
         os.makedirs(EXTRA_DIR)
 
-    skipped_vesta = 0
-
-    for cif2cell_file, vesta_file in zip(cif2cell_files, vesta_files):
-        print('\n')
-        try:
-            cif2cell = read(cif2cell_file, format='vasp')
-            vesta = read(vesta_file, format='vasp')
-        except KeyError:
-            cif2cell = read_vasp_d(cif2cell_file)
-            vesta = read_vasp_d(vesta_file)
-
-        if cif2cell == vesta:
-            print('Files identical; skipping VESTA')
-            files = [cif2cell_file]
-        else:
-            files = [cif2cell_file, vesta_file]
-        space_group_number = []
-        for i, file in enumerate(files):
-            name = os.path.split(file)[-1]
-            print(name)
-
-            out_file = os.path.join(OUT_DIR, name)
-            out_dir = os.path.join(EXTRA_DIR, name.replace('.vasp', ''))
-
-            if os.path.exists(out_file):
-                print('Skipping . . .')
-                break
-
-            os.makedirs(out_dir)
-            copyfile(file, os.path.join(out_dir, 'POSCAR'))
-            os.chdir(out_dir)
-
-            result = subprocess.run(['phonopy', '--symmetry'], stdout=subprocess.PIPE)
-            for line in result.stdout.decode().split('\n'):
-                if 'space_group_number' in line:
-                    space_group_number.append(int(line.strip().split()[-1]))
-                    break
-            else:
-                raise Exception()
-
-            # Abandon VESTA file if the space group is conserved
-            if i == 1:
-                if space_group_number[0] == space_group_number[1]:
-                    skipped_vesta += 1
-                    print(f'Space groups identical ({space_group_number[0]}); skipping VESTA.')
-
-                    os.chdir(DATA_DIR)
-                    rmtree(out_dir)
-                    continue
-                else:
-                    print(f'Space groups different (cif2cell={space_group_number[0]}, vesta={space_group_number[1]}); '
-                          f'keeping both files.')
-
-            os.rename(os.path.join(out_dir, 'PPOSCAR'), out_file)
-            os.chdir(DATA_DIR)
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        skipped_vesta = sum(executor.map(reduce_pair, cif2cell_files, vesta_files))
 
     print(f'FINISHED, skipped {skipped_vesta} vesta files')
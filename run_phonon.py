@@ -12,40 +12,165 @@ conserved from before optimisation. It includes the functionality for determinin
 symmetry was conserved, but it can also work off of the `check_space_group.py` script, in which
 case its outputs are used instead so as not to repeat I/O.
 
-The janus phonon calculations are initiated using the janus CLI via `subprocess` and are run on a
-GPU. However, should the calculations fail due to cuda/PyTorch running out of memory, the run is
-retried with `PYTORCH_CUDA_ALLOC_CONF = 'expandable_segments:True'` environment variable in the
-hopes that that might help, and should there still not be enough memory, the computation will
-instead be run on the CPU, which will likely take significant resources.
+The janus phonon calculations are run on a GPU using the janus Python API, with the MLIP loaded
+only once per GPU; if multiple GPUs are specified, one system is run on each of them in parallel.
+However, should the calculations fail due to cuda/PyTorch running out of memory, the run is
+retried using the janus CLI via `subprocess` with `PYTORCH_CUDA_ALLOC_CONF =
+'expandable_segments:True'` environment variable in the hopes that that might help, and should
+there still not be enough memory, the computation will instead be run on the CPU, which will
+likely take significant resources. Each calculation is run in a scratch directory in `/dev/shm`
+(if available) and its outputs are only moved into the results directory at the end. The scratch
+directories of runs that were killed before they could clean up are removed at the next start.
+
+The supercells are found using fhi-vibes, which cannot be installed alongside janus. It is instead
+expected to be installed in a separate environment and is run in a helper process (see
+`vibes_supercell.py`). The Python interpreter of that environment should be given in the
+`VIBES_PYTHON` environment variable; otherwise, it is taken from the `vibes` executable on the PATH.
 """
 from __future__ import annotations
 
 import argparse
-import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from copy import copy
+from functools import lru_cache
+import gc
+import hashlib
+import json
+import mmap
+from multiprocessing import Queue
 import os
+import re
+import shlex
+import signal
 import subprocess
-from shutil import copyfile, rmtree
+from shutil import copyfile, move, rmtree, which
+import tempfile
 
-from ase.io import read, write
+from ase.io import read
 from ase.build.supercells import find_optimal_cell_shape
 from ase.build import make_supercell
 import numpy as np
+import torch
+
+from janus_core.calculations.phonons import Phonons
+from janus_core.helpers.mlip_calculators import choose_calculator
 
 
 HOME_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(HOME_DIR, 'data')
 OPTIMISED_DIR = os.path.join(DATA_DIR, 'optimised')
 TARGET_DIR = os.path.join(HOME_DIR, 'results')
+SUPERCELL_CACHE_DIR = os.path.join(DATA_DIR, 'supercell_cache')
+VIBES_HELPER = os.path.join(HOME_DIR, 'vibes_supercell.py')
+# The calculations are run in RAM-backed scratch directories where available
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+# Each run keeps its scratch directories in `SCRATCH_DIR/run_phonon-<PID>`
+SCRATCH_PREFIX = 'run_phonon-'
 
 SUPERCELL = '2x2x2'
 IDEAL_VOLUME = 16 ** 3
 MINIMUM_CUTOFF = 7.5
+# Estimate of the GPU memory (in MiB) needed by a janus phonon calculation: a fixed cost for the
+# MLIP, plus a cost per atom in the supercell. These are only initial guesses, which each worker
+# refits to the measurements from its own runs (see :py:func:`record_vram_usage`)
+VRAM_BASE = 2000
+VRAM_PER_ATOM = 20
+CALC_KWARGS = {'dispersion': True}
+# The parts of the janus CLI command that are the same for every system
+JANUS_PHONONS = ['janus', 'phonons', '--calc-kwargs', str(CALC_KWARGS), '--plot-to-file',
+                 '--no-tracker']
+IN_PROCESS_ATTEMPTS = 2
+CUDA_OOM_MESSAGE = 'CUDA out of memory'
+
+# The space group is quoted inside the (itself quoted) log message, e.g.
+# `spacegroup: \"P2_1/c (14)\"`, so the quotes and their escapes are skipped rather than captured
+BEFORE_SPACEGROUP = re.compile(rb'Before optimisation spacegroup: *\\?"?([^"\\\n]*)')
+AFTER_SPACEGROUP = re.compile(rb'After optimization spacegroup: *\\?"?([^"\\\n]*)')
+
+# The MLIP calculator loaded once by each worker process, and the device it runs on (see
+# :py:func:`init_worker`)
+CALCULATOR = None
+DEVICE = 'cuda'
+# The GPU memory (in MiB) taken by the MLIP loaded by this process, and the number of supercell
+# atoms and peak GPU memory (in MiB) of each in-process calculation run by it
+VRAM_MODEL = 0.
+VRAM_SAMPLES = []
+# The fhi-vibes helper process of each process, along with the PID of the process that started it
+# (see :py:func:`find_cubic_cell`)
+VIBES_PROCESS = (None, None)
 
 
 class InvalidLogFile(Exception):
     pass
 
 
+def find_file(directory: str, suffix: str = '', contains: str = '') -> str | None:
+    """
+    Finds the first file in a directory whose name ends with `suffix` and contains `contains`. The
+    search stops as soon as a match is found.
+
+    :param directory: The directory to search
+    :param suffix: The ending the file name must have
+    :param contains: A substring the file name must contain
+
+    :return: The path to the file, or None if there is no such file or the directory does not exist
+    """
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(suffix) and contains in entry.name:
+                    return entry.path
+    except FileNotFoundError:
+        pass
+
+    return None
+
+
+@lru_cache(maxsize=None)
+def get_spacegroups(path: str) -> tuple[str | None, str]:
+    """
+    Reads the space groups before and after optimisation from the yaml log file outputted by janus.
+    The results are cached, so the log file of each system is only read once.
+
+    :param path: Path to a directory containing the output of the `optimise.py` script for one system
+    :return: The space groups before and after optimisation
+    """
+    file = find_file(path, suffix='-log.yml')
+    if file is None:
+        raise InvalidLogFile(f'No janus log file found in {path}')
+    # An empty file cannot be memory-mapped
+    if os.path.getsize(file) == 0:
+        raise InvalidLogFile(f'The janus log file {file} is empty')
+
+    with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        # The space group after optimisation is logged at the very end, so search backwards from
+        # the end of the file to avoid scanning the whole optimisation log
+        after_start = buffer.rfind(b'After optimization spacegroup:')
+        if after_start == -1:
+            raise InvalidLogFile('The janus log file is invalid: maybe the optimisation changed'
+                                 ' or the spec changed in the latest janus version. Regardless,'
+                                 ' the space group information could not be read.')
+
+        before_start = buffer.rfind(b'Before optimisation spacegroup:', 0, after_start)
+
+        before = None if before_start == -1 else parse_spacegroup(
+            BEFORE_SPACEGROUP.match(buffer, before_start)
+        )
+        after = parse_spacegroup(AFTER_SPACEGROUP.match(buffer, after_start))
+
+    return before, after
+
+
+def parse_spacegroup(match: re.Match) -> str:
+    """
+    Extracts the space group from a match of one of the space group patterns on the janus log.
+
+    :param match: The match of `BEFORE_SPACEGROUP` or `AFTER_SPACEGROUP`
+    :return: The space group
+    """
+    return match.group(1).decode().strip()
+
+
 def is_symmetry_broken(path: str) -> bool:
     """
     Checks whether optimisation changed the symmetry of the space group by looking at yaml log
@@ -54,48 +179,70 @@ def is_symmetry_broken(path: str) -> bool:
     :param path: Path to a directory containing the output of the `optimise.py` script for one system
     :return: Whether the symmetry changed during optimisation
     """
-    file = glob.glob(os.path.join(path, '*-log.yml'))[0]
-    
-    before, after = None, None
-    with open(file, 'r') as f:
-        for line in f:
-            #print(line)
-            if 'Before optimisation spacegroup:' in line:
-                before = line.split('Before optimisation spacegroup:')[-1].replace('"', '').strip()
-            elif 'After optimization spacegroup:' in line:
-                after = line.split('After optimization spacegroup:')[-1].replace('"', '').strip()
-                break
-        else:
-            raise InvalidLogFile('The janus log file is invalid: maybe the optimisation changed'
-                                 ' or the spec changed in the latest janus version. Regardless,'
-                                 ' the space group information could not be read.')
+    before, after = get_spacegroups(path)
     return before != after
 
 
-def has_symmetry_changed(src_dir: str, name: str) -> bool:
+def write_symmetry_flag(check_dir: str) -> bool:
     """
-    Checks whether optimisation changed the symmetry of a particular system. First, the flag files
-    created by the `check_space_group.py` script are checked, and if they are not present, the
-    janus log file is used to determine the symmetry change (see :py:func:`is_symmetry_broken`).
+    Determines whether optimisation changed the symmetry of a system from the janus log file, and
+    writes the same flag file as the `check_space_group.py` script so that the log does not have to
+    be read again.
 
-    :param src_dir: The path to the directory holding the results for all systems.
-    :param name: The name of the system - this is the same name as the folder corresponding to the
-                 system in `src_dir/extra_data`
+    :param check_dir: Path to a directory containing the output of the `optimise.py` script for one
+                      system
 
     :return: Whether the symmetry changed
     """
-    check_dir = os.path.join(src_dir, 'extra_data', name)
-    if os.path.exists(os.path.join(check_dir, 'spacegroup_changed')):
-        print(f'Skipping {name} because optimisation changed space group')
-        return True
-    elif os.path.exists(os.path.join(check_dir, 'spacegroup_conserved')):
-        return False
-    else:
-        if is_symmetry_broken(check_dir):
-            print(f'Skipping {name} because optimisation changed space group')
-            return True
+    before, after = get_spacegroups(check_dir)
+    title = 'spacegroup_changed' if before != after else 'spacegroup_conserved'
 
-    return False
+    with open(os.path.join(check_dir, title), 'w') as f:
+        f.write(f'{before}   {after}')
+
+    return before != after
+
+
+def get_changed_symmetries(src_dir: str, names: list[str]) -> set[str]:
+    """
+    Finds all systems for which optimisation changed the symmetry. The flag files created by the
+    `check_space_group.py` script are used where present, with each system's directory listed only
+    once; for the rest, the janus log files are read in parallel and the flag files are written
+    (see :py:func:`write_symmetry_flag`). Systems whose log file is missing or invalid (e.g.
+    because the optimisation was killed early) are reported and included as well, so that they are
+    skipped, but no flag file is written for them.
+
+    :param src_dir: The path to the directory holding the results for all systems.
+    :param names: The names of the systems - these are the same names as the folders corresponding
+                  to the systems in `src_dir/extra_data`
+
+    :return: The names of the systems whose symmetry changed or could not be determined
+    """
+    changed, unchecked = set(), {}
+    for name in names:
+        check_dir = os.path.join(src_dir, 'extra_data', name)
+        contents = set(os.listdir(check_dir))
+
+        if 'spacegroup_changed' in contents:
+            changed.add(name)
+        elif 'spacegroup_conserved' not in contents:
+            unchecked[name] = check_dir
+
+    with ThreadPoolExecutor() as executor:
+        futures = {executor.submit(write_symmetry_flag, check_dir): name
+                   for name, check_dir in unchecked.items()}
+
+        for future in as_completed(futures):
+            try:
+                broken = future.result()
+            except InvalidLogFile as e:
+                print(f'Skipping {futures[future]}: {e}')
+                broken = True
+
+            if broken:
+                changed.add(futures[future])
+
+    return changed
 
 
 def is_calculation_complete(work_dir: str, name: str) -> bool:
@@ -109,8 +256,7 @@ def is_calculation_complete(work_dir: str, name: str) -> bool:
 
     :return: Whether the calculation completed successfully
     """
-    if glob.glob(os.path.join(work_dir, '*force_constants*')):
-        print(f'Skipping {name} because it is already complete')
+    if find_file(work_dir, contains='force_constants') is not None:
         return True
 
     try:
@@ -122,62 +268,575 @@ def is_calculation_complete(work_dir: str, name: str) -> bool:
     return False
 
 
-def get_supercell(path: str, work_dir: str, multiplier: float = 1.) -> str | None:
+def link_file(src: str, dest: str) -> None:
     """
-    Constructs a supercell to use for the phonon calculations with janus.
+    Hard links a file into a new location, so that the data does not have to be copied. Falls back
+    to copying the file if a hard link cannot be made, e.g. because the destination is on a
+    different file system.
 
-    :param path: The path to the structure file to use.
-    :return: The supercell as a string for input to janus phonons CLI.
+    :param src: The path to the file to link
+    :param dest: The path to link the file to
     """
-    atoms = read(path, format='vasp')
-    geom_path = os.path.join(work_dir, 'geometry.in')
-    write(geom_path, atoms)
+    try:
+        os.link(src, dest)
+    except OSError:
+        copyfile(src, dest)
 
-    target_size = round(IDEAL_VOLUME / atoms.cell.volume)
-    target_n = len(atoms.get_atomic_numbers()) * target_size * multiplier
-    print(f'getting supercell: target={target_size} target n atom={target_n}')
 
-    result = subprocess.run(['vibes', 'utils', 'make-supercell', 
-                             geom_path, '-n', str(int(target_n))],
-                            capture_output=True, encoding='utf8')
+def read_poscar_cell(path: str) -> tuple[np.ndarray, int]:
+    """
+    Reads only the lattice vectors and the number of atoms from a POSCAR file, which is all that is
+    needed to construct a supercell, without building the full ASE Atoms object. Should the header
+    not be in the expected format, the file is read using ASE instead.
 
-    for line in result.stdout.split('\n'):
-        if 'cmdline:' in line:
-            cell = line.replace('cmdline:', '').strip()
-            break
-    else:
-        if 'LinAlgError' in result.stderr:
-            return get_supercell(path, work_dir, multiplier + 0.5)
-        print(result.returncode, result.stdout, result.stderr)
-        raise Exception()
-
-    for line in result.stdout.split('\n'):
-        if 'Largest Cutoff' in line:
-            cut_off = float(line.split()[-2])
-            break
-    else:
-        raise Exception()
+    :param path: The path to the POSCAR file.
+    :return: The cell as a 3x3 array with the lattice vectors as rows, and the number of atoms.
+    """
+    with open(path, 'r') as f:
+        lines = [f.readline() for _ in range(7)]
+
+    try:
+        cell = np.array([line.split()[:3] for line in lines[2:5]], dtype=float)
+
+        # A negative scaling factor is the volume of the cell rather than a multiplier
+        scale, = (float(value) for value in lines[1].split())
+        if scale < 0:
+            scale = (-scale / abs(np.linalg.det(cell))) ** (1 / 3)
+        cell *= scale
+
+        # VASP 5 files have a line of element symbols before the line of atom counts
+        counts = lines[5].split()
+        if not counts[0].isdigit():
+            counts = lines[6].split()
+
+        return cell, sum(int(count) for count in counts if count.isdigit())
+    except (ValueError, IndexError):
+        # Anything unusual (e.g. separate scaling factors for each axis) is left to ASE
+        atoms = read(path, format='vasp')
+        return atoms.cell.array, len(atoms)
+
+
+def find_vibes_python() -> list[str]:
+    """
+    Finds the Python interpreter of the environment in which fhi-vibes is installed. This is taken
+    from the `VIBES_PYTHON` environment variable if it is set, and otherwise from the shebang of
+    the `vibes` executable, as long as the shebang points straight at a Python interpreter (rather
+    than e.g. `/usr/bin/env python`, which could resolve to the wrong environment, or a shell).
+
+    :return: The command for running the interpreter
+    """
+    if os.environ.get('VIBES_PYTHON'):
+        return shlex.split(os.environ['VIBES_PYTHON'])
+
+    vibes = which('vibes')
+    if vibes is None:
+        raise FileNotFoundError('The vibes executable could not be found; set VIBES_PYTHON to the '
+                                'Python interpreter of the environment with fhi-vibes installed')
+
+    with open(vibes, 'r') as f:
+        shebang = f.readline()
+
+    command = shlex.split(shebang[2:]) if shebang.startswith('#!') else []
+    if not command or not os.path.basename(command[0]).startswith('python'):
+        raise FileNotFoundError(f'Could not determine the Python interpreter of {vibes}; set '
+                                f'VIBES_PYTHON to the Python interpreter of its environment')
+
+    return command
+
+
+def find_cubic_cell(cell: np.ndarray, target_size: float) -> np.ndarray:
+    """
+    Finds the supercell matrix producing the most cubic supercell of a given size using the
+    fhi-vibes helper process (see `vibes_supercell.py`). The helper is started the first time this
+    is called in a process and reused afterwards, and it is restarted if it has exited.
+
+    :param cell: The cell as a 3x3 array with the lattice vectors as rows
+    :param target_size: The target number of unit cells in the supercell
+    :return: The 3x3 supercell matrix
+    """
+    global VIBES_PROCESS
+
+    # Processes forked from this one inherit the helper, but must not share its pipes
+    pid, process = VIBES_PROCESS
+    if pid != os.getpid() or process.poll() is not None:
+        process = subprocess.Popen(find_vibes_python() + [VIBES_HELPER], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, text=True)
+        VIBES_PROCESS = (os.getpid(), process)
+
+    process.stdin.write(json.dumps({'cell': cell.tolist(), 'target_size': target_size}) + '\n')
+    process.stdin.flush()
+
+    response = process.stdout.readline()
+    if not response:
+        raise RuntimeError('The fhi-vibes helper process exited unexpectedly')
+
+    response = json.loads(response)
+    if 'error' in response:
+        raise RuntimeError(f'fhi-vibes could not find a supercell: {response["error"]}')
+
+    return np.array(response['smatrix'], dtype=int)
+
+
+def inscribed_sphere_in_box(cell: np.ndarray) -> float:
+    """
+    Computes the radius of the largest sphere that fits inside a cell, i.e. half of the smallest
+    distance between opposing faces of the cell. This is the same as the fhi-vibes function of the
+    same name.
 
-    for geometry in glob.glob(os.path.join(work_dir, '*.in')):
-        os.remove(geometry)
+    :param cell: The cell as a 3x3 array with the lattice vectors as rows
+    :return: The radius of the sphere
+    """
+    normals = np.cross(cell[[1, 2, 0]], cell[[2, 0, 1]])
+    return 0.5 * abs(np.linalg.det(cell)) / np.linalg.norm(normals, axis=1).max()
+
+
+def find_supercell_matrix(cell: np.ndarray, target_size: float) -> np.ndarray:
+    """
+    Finds the supercell matrix producing the most cubic supercell of a given size using vibes (see
+    :py:func:`find_cubic_cell`). The
+    search is deterministic, so its results are cached on disk in `SUPERCELL_CACHE_DIR`, keyed by
+    the cell and the target size, and reused across runs (e.g. with a different MLIP).
+
+    :param cell: The cell as a 3x3 array with the lattice vectors as rows
+    :param target_size: The target number of unit cells in the supercell
+    :return: The 3x3 supercell matrix
+    """
+    key = hashlib.sha1(np.ascontiguousarray(cell, dtype=np.float64).tobytes()
+                       + str(target_size).encode()).hexdigest()
+    path = os.path.join(SUPERCELL_CACHE_DIR, f'{key}.npy')
+
+    try:
+        return np.load(path)
+    except FileNotFoundError:
+        pass
+
+    smatrix = find_cubic_cell(cell, target_size)
+
+    # Write to a temporary file first so that parallel processes never read a partial file
+    os.makedirs(SUPERCELL_CACHE_DIR, exist_ok=True)
+    temp_path = os.path.join(SUPERCELL_CACHE_DIR, f'{key}.{os.getpid()}.npy')
+    np.save(temp_path, smatrix)
+    os.replace(temp_path, path)
+
+    return smatrix
+
+
+def get_supercell(path: str) -> np.ndarray | None:
+    """
+    Constructs a supercell to use for the phonon calculations with janus. The target number of
+    atoms is increased in steps until the supercell is large enough for the cutoff.
+
+    :param path: The path to the structure file to use.
+    :return: The flattened 3x3 supercell matrix.
+    """
+    cell, n_atoms = read_poscar_cell(path)
+    target_size = max(round(IDEAL_VOLUME / abs(np.linalg.det(cell))), 1)
+
+    multiplier = 1.
+    while True:
+        target_n = n_atoms * target_size * multiplier
+        print(f'getting supercell: target={target_size} target n atom={target_n}')
+
+        smatrix = find_supercell_matrix(cell, int(target_n) / n_atoms)
+        # A singular matrix is what used to make vibes raise a LinAlgError when building the
+        # supercell
+        if round(np.linalg.det(smatrix)) == 0:
+            cut_off = 0.
+        else:
+            cut_off = inscribed_sphere_in_box(smatrix @ cell)
+
+        if cut_off >= MINIMUM_CUTOFF:
+            return smatrix.flatten()
 
-    if cut_off < MINIMUM_CUTOFF:
         if target_n > 1000:
             print(f'FAILED!!!!!!!!!!!!!!!!   max_cutoff={cut_off}')
             return None
 
-        cell = get_supercell(path, work_dir, multiplier + 0.5)
+        multiplier += 0.5
+
 
-    return cell
+def compute_supercells(files: list[str]) -> dict[str, np.ndarray | None]:
+    """
+    Constructs the supercells (see :py:func:`get_supercell`) of many systems in parallel, using one
+    process per CPU. Each process starts its own fhi-vibes helper (see :py:func:`find_cubic_cell`),
+    so the supercell searches themselves also run in parallel.
 
+    :param files: The paths to the structure files
+    :return: Mapping of each structure file to its supercell
+    """
+    with ProcessPoolExecutor() as executor:
+        return dict(zip(files, executor.map(get_supercell, files)))
 
-def get_sc_supercell(cell: np.ndarray, target: int):
-    metric = np.eye(3)
-    norm = (target * abs(np.linalg.det(cell)) / np.linalg.det(metric)) ** (-1 / 3)
-    norm_cell = norm * cell
 
-    ideal = np.dot(metric, np.linalg.inv(norm_cell))
-    return np.array(np.around(ideal, 0), dtype=int)
+def load_supercells(path: str) -> dict[str, np.ndarray]:
+    """
+    Loads the supercells of all systems saved by :py:func:`save_supercells`.
+
+    :param path: The path to the `supercells.npz` file
+    :return: Mapping of each system name to its flattened 3x3 supercell matrix, which is empty if
+             the file does not exist
+    """
+    if not os.path.exists(path):
+        return {}
+
+    with np.load(path) as f:
+        return dict(zip(f['names'].tolist(), f['matrices']))
+
+
+def save_supercells(path: str, supercells: dict[str, np.ndarray]) -> None:
+    """
+    Saves the supercells of all systems into one `.npz` file, as an array of the system names and
+    an array of the corresponding flattened supercell matrices. The names are not used as the keys
+    of the file, since a name such as `file` would clash with the arguments of `np.savez`.
+
+    :param path: The path to the `supercells.npz` file
+    :param supercells: Mapping of each system name to its flattened 3x3 supercell matrix
+    """
+    names = sorted(supercells)
+    matrices = np.array([supercells[name] for name in names], dtype=int).reshape(-1, 9)
+
+    # Write to a temporary file first so that a run killed while writing does not corrupt the file
+    temp_path = f'{path[:-len(".npz")]}.{os.getpid()}.npz'
+    np.savez_compressed(temp_path, names=np.array(names, dtype=str), matrices=matrices)
+    os.replace(temp_path, path)
+
+
+def init_worker(devices: Queue, arch: str, model_path: str) -> None:
+    """
+    Initialises a worker process for running the janus calculations by pinning it to one of the
+    available GPUs via the `CUDA_VISIBLE_DEVICES` environment variable, and loading the MLIP onto
+    it once so that it can be reused for all the systems run by the worker. The GPU memory taken by
+    the MLIP is recorded as `VRAM_MODEL`. Whether a GPU is available is checked only once here, and
+    if it is not, the worker runs everything on the CPU. Should loading the MLIP fail, the worker
+    falls back to the janus CLI.
+
+    :param devices: Queue of the GPU IDs that have not yet been assigned to a worker. `None` means
+                    that the default device is used.
+    :param arch: The "--arch" parameter for janus
+    :param model_path: The "--model-path" parameter for janus
+    """
+    global CALCULATOR, DEVICE, VRAM_MODEL
+
+    # Only the main process cleans up, so the workers are simply terminated
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    device = devices.get()
+    if device is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = device
+
+    if not torch.cuda.is_available():
+        print('No GPU available; all calculations will be run on the CPU')
+        DEVICE = 'cpu'
+
+    try:
+        CALCULATOR = choose_calculator(arch=arch, device=DEVICE, model_path=model_path,
+                                       **CALC_KWARGS)
+    except Exception as e:
+        # Anything escaping the initializer would break the whole pool
+        print(f'Could not load the MLIP on {DEVICE} ({type(e).__name__}: {e}); the janus CLI '
+              f'will be used instead')
+        return
+
+    if DEVICE == 'cuda':
+        VRAM_MODEL = torch.cuda.memory_reserved() / 2 ** 20
+
+
+def remove_stale_scratch_dirs() -> None:
+    """
+    Removes the scratch directories in `SCRATCH_DIR` left behind by runs of this script that were
+    killed (e.g. by SLURM) before they could clean up, i.e. those whose process no longer exists.
+    """
+    with os.scandir(SCRATCH_DIR) as entries:
+        for entry in entries:
+            if not entry.name.startswith(SCRATCH_PREFIX):
+                continue
+
+            try:
+                pid = int(entry.name[len(SCRATCH_PREFIX):])
+                os.kill(pid, 0)
+            except ValueError:
+                continue
+            except ProcessLookupError:
+                print(f'Removing stale scratch directory {entry.path}')
+                rmtree(entry.path, ignore_errors=True)
+            except PermissionError:
+                # The process exists but belongs to another user
+                continue
+
+
+def handle_sigterm(signum, frame) -> None:
+    """
+    Turns SIGTERM (as sent by SLURM when a job is cancelled or runs out of time) into a normal exit,
+    so that the scratch directories are still cleaned up.
+    """
+    raise SystemExit(128 + signum)
+
+
+def run_phonons(work_dir: str,
+                scratch_root: str,
+                name: str,
+                supercell: np.ndarray,
+                arch: str,
+                model_path: str) -> None:
+    """
+    Runs the phonon calculation for one system (see :py:func:`run_calculation`) in a scratch
+    directory in `scratch_root`, so that the many small files written by janus do not go through a
+    potentially slow file system. The outputs are moved into `work_dir` only if the calculation
+    succeeds, with the force constants file moved last since its presence is what marks the
+    calculation as complete (see :py:func:`is_calculation_complete`).
+
+    :param work_dir: The path to the directory containing the POSCAR file of the system, to which
+                     the results are written
+    :param scratch_root: The path to the scratch directory of this run
+    :param name: The name of the system
+    :param supercell: The flattened 3x3 supercell matrix
+    :param arch: The "--arch" parameter for janus
+    :param model_path: The "--model-path" parameter for janus
+    """
+    scratch_dir = os.path.join(scratch_root, name)
+    rmtree(scratch_dir, ignore_errors=True)
+    os.makedirs(scratch_dir)
+    try:
+        copyfile(os.path.join(work_dir, 'POSCAR'), os.path.join(scratch_dir, 'POSCAR'))
+        run_calculation(scratch_dir, name, supercell, arch, model_path)
+
+        with os.scandir(scratch_dir) as entries:
+            outputs = sorted((entry for entry in entries if entry.name != 'POSCAR'),
+                             key=lambda entry: 'force_constants' in entry.name)
+
+        for entry in outputs:
+            move(entry.path, os.path.join(work_dir, entry.name))
+    finally:
+        rmtree(scratch_dir, ignore_errors=True)
+
+
+def run_calculation(work_dir: str,
+                    name: str,
+                    supercell: np.ndarray,
+                    arch: str,
+                    model_path: str) -> None:
+    """
+    Runs the phonon calculation for one system in-process, reusing the MLIP loaded by
+    :py:func:`init_worker`. The PyTorch cache is emptied after every attempt, and a run that
+    runs out of GPU memory is retried up to `IN_PROCESS_ATTEMPTS` times in total. Should that
+    fail, or should the run fail for any other reason, the calculation is instead run using the
+    janus CLI (see :py:func:`run_janus`), starting with expandable segments if the in-process runs
+    ran out of memory. The in-process run is skipped if the supercell is not expected to fit into
+    the free GPU memory, in which case the CLI is also run with expandable segments from the start.
+
+    :param work_dir: The path to the directory containing the POSCAR file of the system, to which
+                     the results are written
+    :param name: The name of the system
+    :param supercell: The flattened 3x3 supercell matrix
+    :param arch: The "--arch" parameter for janus
+    :param model_path: The "--model-path" parameter for janus
+    """
+    expandable = False
+    if CALCULATOR is not None:
+        n_supercell_atoms = count_supercell_atoms(work_dir, supercell)
+        if DEVICE == 'cuda':
+            # The MLIP is already loaded, so its memory is not needed again
+            required = VRAM_BASE + VRAM_PER_ATOM * n_supercell_atoms - VRAM_MODEL
+            expandable = not fits_in_vram(required, n_supercell_atoms)
+
+    if CALCULATOR is not None and not expandable:
+        for attempt in range(1, IN_PROCESS_ATTEMPTS + 1):
+            atoms = read(os.path.join(work_dir, 'POSCAR'), format='vasp')
+            atoms.calc = copy(CALCULATOR)
+
+            try:
+                if DEVICE == 'cuda':
+                    torch.cuda.reset_peak_memory_stats()
+
+                phonons = Phonons(struct=atoms,
+                                  arch=arch,
+                                  device=DEVICE,
+                                  model_path=model_path,
+                                  calc_kwargs=CALC_KWARGS,
+                                  attach_logger=True,
+                                  track_carbon=False,
+                                  supercell=supercell.tolist(),
+                                  plot_to_file=True,
+                                  write_results=True,
+                                  file_prefix=os.path.join(work_dir, name))
+                phonons.run()
+
+                if DEVICE == 'cuda':
+                    record_vram_usage(n_supercell_atoms)
+                return
+            except torch.cuda.OutOfMemoryError:
+                print(f'in-process run ran out of GPU memory (attempt {attempt})')
+                # A plain CLI run would fare no better with this worker's MLIP still on the GPU
+                expandable = True
+            except Exception as e:
+                print(f'in-process run failed ({type(e).__name__}: {e})')
+                expandable = False
+                break
+            finally:
+                # Release the cached memory so that the next run starts with a clean allocator
+                gc.collect()
+                torch.cuda.empty_cache()
+
+        print('retrying using the janus CLI')
+
+    run_janus(work_dir, name, supercell, arch, model_path, expandable)
+
+
+def count_supercell_atoms(work_dir: str, supercell: np.ndarray) -> int:
+    """
+    Counts the atoms in the supercell of a system.
+
+    :param work_dir: The path to the directory containing the POSCAR file of the system
+    :param supercell: The flattened 3x3 supercell matrix
+    :return: The number of atoms in the supercell
+    """
+    _, n_atoms = read_poscar_cell(os.path.join(work_dir, 'POSCAR'))
+    return n_atoms * abs(round(np.linalg.det(supercell.reshape(3, 3))))
+
+
+def fits_in_vram(required: float, n_supercell_atoms: int) -> bool:
+    """
+    Checks whether a calculation is expected to fit into the free memory on the GPU, with a 10%
+    margin. If the free memory cannot be determined, the calculation is assumed to fit.
+
+    :param required: The estimated GPU memory needed by the calculation in MiB
+    :param n_supercell_atoms: The number of atoms in the supercell, used only for the message
+    :return: Whether the calculation is expected to fit
+    """
+    free = get_free_vram()
+    if free is None or required <= 0.9 * free:
+        return True
+
+    print(f'supercell of {n_supercell_atoms} atoms needs ~{required:.0f} MiB of the {free} MiB '
+          f'free on the GPU; using PYTORCH_CUDA_ALLOC_CONF=expandable_segments:True')
+    return False
+
+
+def record_vram_usage(n_supercell_atoms: int) -> None:
+    """
+    Records the peak GPU memory used by an in-process calculation that has just finished, and
+    refits `VRAM_BASE` and `VRAM_PER_ATOM` to all the calculations run by this process so far. Once
+    supercells of at least two sizes have been run, both are fitted by least squares, so that the
+    fixed cost of a run is not counted towards the cost per atom; until then, only `VRAM_BASE` is
+    adjusted so that the estimate matches the measurement.
+
+    :param n_supercell_atoms: The number of atoms in the supercell of the calculation
+    """
+    global VRAM_BASE, VRAM_PER_ATOM
+
+    VRAM_SAMPLES.append((n_supercell_atoms, torch.cuda.max_memory_reserved() / 2 ** 20))
+    n_atoms, peaks = np.array(VRAM_SAMPLES).T
+
+    if len(np.unique(n_atoms)) < 2:
+        VRAM_BASE = peaks.max() - VRAM_PER_ATOM * n_atoms[0]
+        return
+
+    per_atom, base = np.polyfit(n_atoms, peaks, 1)
+    # Noisy measurements of similar sizes can give a meaningless slope, which is ignored
+    if per_atom > 0:
+        VRAM_BASE, VRAM_PER_ATOM = base, per_atom
+
+
+def run_janus(work_dir: str,
+              name: str,
+              supercell: np.ndarray,
+              arch: str,
+              model_path: str,
+              expandable: bool = False) -> None:
+    """
+    Runs the janus phonon calculation for one system. Should the calculation fail on the GPU, it is
+    retried with `PYTORCH_CUDA_ALLOC_CONF = 'expandable_segments:True'`, and then on the CPU.
+    The GPU memory needed is estimated beforehand (see `VRAM_BASE` and `VRAM_PER_ATOM`) and compared
+    with the free memory, so that systems which are unlikely to fit start with expandable segments.
+    Either way, the GPU is always tried before the CPU. Workers without a GPU run on the CPU from
+    the start. Should the CPU run fail too, `subprocess.CalledProcessError` is raised.
+
+    :param work_dir: The path to the directory containing the POSCAR file of the system, to which
+                     the results are written
+    :param name: The name of the system
+    :param supercell: The flattened 3x3 supercell matrix
+    :param arch: The "--arch" parameter for janus
+    :param model_path: The "--model-path" parameter for janus
+    :param expandable: Whether to start with expandable segments rather than checking the
+                       estimate
+    """
+    base_args = JANUS_PHONONS + ['--struct', os.path.join(work_dir, 'POSCAR'),
+                                 '--supercell', ' '.join(supercell.astype(str)),
+                                 '--arch', arch,
+                                 '--model-path', model_path,
+                                 '--file-prefix', os.path.join(work_dir, name)]
+
+    if DEVICE == 'cpu':
+        subprocess.run(base_args + ['--device', 'cpu'], cwd=work_dir, check=True)
+        return
+
+    env = os.environ.copy()
+    env['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'
+
+    if not expandable:
+        n_supercell_atoms = count_supercell_atoms(work_dir, supercell)
+        expandable = not fits_in_vram(VRAM_BASE + VRAM_PER_ATOM * n_supercell_atoms,
+                                      n_supercell_atoms)
+
+    try:
+        if not expandable:
+            try:
+                run_cuda_command(base_args + ['--device', 'cuda'], work_dir)
+                return
+            except subprocess.CalledProcessError:
+                print('cuda run failed; retrying using '
+                      'PYTORCH_CUDA_ALLOC_CONF=expandable_segments:True')
+
+        run_cuda_command(base_args + ['--device', 'cuda'], work_dir, env)
+    except subprocess.CalledProcessError:
+        print('cuda run failed with expandable segments; retrying using CPU only')
+        subprocess.run(base_args + ['--device', 'cpu'], cwd=work_dir, check=True)
+
+
+def run_cuda_command(args: list[str], work_dir: str, env: dict[str, str] | None = None) -> None:
+    """
+    Runs a janus CLI command on the GPU, echoing its output as it is produced. As soon as the
+    output reports that CUDA ran out of memory, the process is killed rather than waiting for
+    janus to give up, so that the GPU is freed for the next attempt straight away. Either way, a
+    failed run raises `subprocess.CalledProcessError`.
+
+    :param args: The command to run
+    :param work_dir: The directory to run the command in
+    :param env: The environment variables to run the command with, by default those of this process
+    """
+    # Output to a pipe is block-buffered, so the OOM message would otherwise only arrive late
+    env = dict(os.environ if env is None else env, PYTHONUNBUFFERED='1')
+    with subprocess.Popen(args, cwd=work_dir, env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, text=True) as process:
+        for line in process.stdout:
+            print(line, end='')
+            if CUDA_OOM_MESSAGE in line:
+                process.kill()
+                break
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args)
+
+
+def get_free_vram() -> int | None:
+    """
+    Queries the free memory on the GPU assigned to this process using `nvidia-smi`.
+
+    :return: The free GPU memory in MiB, or None if it could not be determined
+    """
+    device = os.environ.get('CUDA_VISIBLE_DEVICES', '0').split(',')[0]
+    try:
+        result = subprocess.run(['nvidia-smi', '--query-gpu=memory.free',
+                                 '--format=csv,noheader,nounits', '-i', device],
+                                capture_output=True, text=True, check=True)
+        return int(result.stdout.split()[0])
+    except (OSError, subprocess.CalledProcessError, ValueError, IndexError):
+        return None
+
+
+def get_sc_supercell(cell: np.ndarray, target: int) -> np.ndarray:
+    norm = (target * abs(np.linalg.det(cell))) ** (-1 / 3)
+    return np.rint(np.linalg.inv(norm * cell)).astype(int)
 
 
 if __name__ == '__main__':
@@ -193,6 +852,10 @@ if __name__ == '__main__':
                         help='Disregards everything and only print out the supercell target sizes.')
     parser.add_argument('-rs', '--redo-supercells', action='store_true',
                         help='Redoes the supercells')
+    parser.add_argument('-g', '--gpus', type=str, nargs='+', default=None,
+                        help='The IDs of the GPUs to use, one system being run on each GPU at a '
+                             'time. If not provided, one system is run at a time on the default '
+                             'device.')
     args = parser.parse_args()
 
     if os.path.exists(args.model_path):
@@ -217,63 +880,111 @@ if __name__ == '__main__':
         if not os.path.exists(dest_dir):
             os.makedirs(dest_dir)
 
-    data_files = sorted(glob.glob(os.path.join(src_dir, '*.vasp')))
+    with os.scandir(src_dir) as entries:
+        data_files = sorted(entry.path for entry in entries if entry.name.endswith('.vasp'))
     #print(data_files)
-    
-    for file in data_files:
-        name = os.path.split(file)[-1].replace('.vasp', '')
-        work_dir = os.path.join(dest_dir, name)
-        print(name)
-
-        if not args.check_supercells:
-            if has_symmetry_changed(src_dir, name) or is_calculation_complete(work_dir, name):
-               continue
-        
-        os.makedirs(work_dir, exist_ok=True)
-        os.chdir(work_dir)
-        try:
-            copyfile(file, os.path.join(work_dir, 'POSCAR'))
-        except FileExistsError:
-            if not args.check_supercells:
-                raise
-
-        supercell_path = os.path.join(work_dir, 'supercell.npy')
-        if os.path.exists(supercell_path) and not args.redo_supercells:
-            supercell = np.load(supercell_path)
-            print(f'supercell = {supercell}')
-        else:
-            supercell = get_supercell(file, work_dir)
-            if supercell is None:
+
+    supercells_path = os.path.join(dest_dir, 'supercells.npz')
+    supercells = load_supercells(supercells_path)
+
+    # The supercells used to be saved in a `supercell.npy` file in the directory of each system, so
+    # any such files are carried over (before incomplete calculations are deleted below)
+    with os.scandir(dest_dir) as entries:
+        for entry in entries:
+            legacy_path = os.path.join(entry.path, 'supercell.npy')
+            if entry.name not in supercells and os.path.isfile(legacy_path):
+                supercells[entry.name] = np.load(legacy_path).flatten()
+
+    if not args.check_supercells:
+        symmetry_changed = get_changed_symmetries(
+            src_dir, [os.path.split(file)[-1].replace('.vasp', '') for file in data_files]
+        )
+        with os.scandir(dest_dir) as entries:
+            started = {entry.name for entry in entries if entry.is_dir()}
+
+        pending, n_complete = [], 0
+        for file in data_files:
+            name = os.path.split(file)[-1].replace('.vasp', '')
+            if name in symmetry_changed:
                 continue
+            elif name in started and is_calculation_complete(os.path.join(dest_dir, name), name):
+                n_complete += 1
+            else:
+                pending.append(file)
+
+        print(f'Skipping {len(symmetry_changed)} systems because optimisation changed space group '
+              f'(or its log is invalid) and {n_complete} because they are already complete')
+        data_files = pending
+
+    if args.check_supercells:
+        missing = [file for file in data_files
+                   if os.path.split(file)[-1].replace('.vasp', '') not in supercells]
+        computed = compute_supercells(data_files if args.redo_supercells else missing)
+    else:
+        computed = {}
+
+    # Nothing is run with --check-supercells, so it needs neither the scratch space nor the workers
+    executor, scratch_root = None, None
+    if not args.check_supercells:
+        remove_stale_scratch_dirs()
+        scratch_root = os.path.join(SCRATCH_DIR, f'{SCRATCH_PREFIX}{os.getpid()}')
+        os.makedirs(scratch_root, exist_ok=True)
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+        devices = args.gpus or [None]
+        device_queue = Queue()
+        for device in devices:
+            device_queue.put(device)
+
+        executor = ProcessPoolExecutor(max_workers=len(devices), initializer=init_worker,
+                                       initargs=(device_queue, args.arch, args.model_path))
+    futures = {}
+
+    try:
+        for file in data_files:
+            name = os.path.split(file)[-1].replace('.vasp', '')
+            work_dir = os.path.join(dest_dir, name)
+            print(name)
+
+            if name in supercells and not args.redo_supercells:
+                supercell = supercells[name]
+                print(f'supercell = {supercell}')
+            else:
+                supercell = computed[file] if file in computed else get_supercell(file)
+                if supercell is None:
+                    continue
         
-            print(f'supercell = {supercell}')
-            np.save(supercell_path, np.array(supercell.split()).astype(int))
-
-        if args.check_supercells:
-            continue
-
-        base_args = ['janus', 'phonons',
-                     '--struct', './POSCAR',
-                     '--supercell', supercell,
-                     '--arch', args.arch,
-                     '--model-path', args.model_path,
-                     '--calc-kwargs', '{"dispersion": True}',
-                     '--plot-to-file',
-                     '--file-prefix', name,
-                     '--no-tracker']
-        
-        try:
-            result = subprocess.run(base_args + ['--device', 'cuda'], check=True)
-        except subprocess.CalledProcessError:
-            print('cuda run failed; retrying using PYTORCH_CUDA_ALLOC_CONF=expandable_segments:True')
-            try:
-                env = os.environ.copy()
-                env['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'
-                result = subprocess.run(base_args + ['--device', 'cuda'], check=True, env=env)
-            except subprocess.CalledProcessError:
-                print('cuda run failed again; retrying using CPU only')
-                subprocess.run(base_args + ['--device', 'cpu'])
+                print(f'supercell = {supercell}')
+                supercells[name] = supercell
+
+            if args.check_supercells:
+                continue
+
+            os.makedirs(work_dir, exist_ok=True)
+            link_file(file, os.path.join(work_dir, 'POSCAR'))
 
-        os.chdir(HOME_DIR)
+            future = executor.submit(run_phonons, work_dir, scratch_root, name, supercell,
+                                     args.arch, args.model_path)
+            futures[future] = name
+
+        save_supercells(supercells_path, supercells)
+
+        # A failed system is reported and the rest are left to finish, since the next run redoes it
+        failed = []
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f'{futures[future]} failed ({type(e).__name__}: {e})')
+                failed.append(futures[future])
+
+        if executor is not None:
+            executor.shutdown()
+    finally:
+        if scratch_root is not None:
+            rmtree(scratch_root, ignore_errors=True)
+
+    if failed:
+        print(f'{len(failed)} systems failed: {", ".join(sorted(failed))}')
 
     print('FINISHED')
@@ -0,0 +1,44 @@
+"""
+Helper script used by `run_phonon.py` for finding the most cubic supercell of a given size using
+fhi-vibes.
+
+fhi-vibes cannot be installed in the same environment as janus (it requires older versions of ase
+and numpy), so this script is run with the Python interpreter of a separate environment in which
+fhi-vibes is installed. It is started once and then kept running, so that vibes is only imported
+once rather than for every system.
+
+Each line read from stdin is a JSON request of the form
+`{"cell": [[...], [...], [...]], "target_size": 4.0}`, where `target_size` is the target number of
+unit cells in the supercell. For each request, one line of JSON is written to stdout holding either
+the 3x3 supercell matrix (`{"smatrix": [[...], [...], [...]]}`) or the error that occurred
+(`{"error": "..."}`).
+"""
+import json
+import os
+import sys
+
+import numpy as np
+from vibes.helpers.supercell import find_cubic_cell
+
+
+DEVIATION = 0.2
+
+
+if __name__ == '__main__':
+    # Anything printed by vibes (including its Fortran extension) would corrupt the responses, so
+    # the responses are written to a copy of stdout, and stdout itself is redirected to stderr
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            smatrix = find_cubic_cell(np.array(request['cell']),
+                                      target_size=request['target_size'],
+                                      deviation=DEVIATION)
+            response = {'smatrix': smatrix.tolist()}
+        except Exception as e:
+            response = {'error': f'{type(e).__name__}: {e}'}
+
+        responses.write(json.dumps(response) + '\n')
+        responses.flush()